@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from io import BytesIO
+
+import google.generativeai as genai
+
+from pokedex import (
+    CAPTURE_BACKUP_COUNT, CAPTURE_EVENTS_FILE, CAPTURE_IMAGE_DIR, file_handler, identify_pokemon, logger, remove_background
+)
+
+TIMED_STAGES = ("background", "identify")
+
+
+def read_events(events_file):
+    for index in range(CAPTURE_BACKUP_COUNT, 0, -1):
+        rotated_file = f"{events_file}.{index}"
+        if os.path.exists(rotated_file):
+            yield from read_event_file(rotated_file)
+    yield from read_event_file(events_file)
+
+
+def read_event_file(events_file):
+    with open(events_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def load_dataset(events_file):
+    samples = {}
+    for event in read_events(events_file):
+        sample = samples.setdefault(event["image"], {
+            "image": event["image"],
+            "initial_name": None,
+            "answers": set(),
+            "label": None,
+            "known_wrong": set(),
+            "corrected": False,
+            "ambiguous": False,
+            "recorded_timings": []
+        })
+        if event["type"] == "identification":
+            if sample["initial_name"] is None:
+                sample["initial_name"] = event.get("name")
+            if event.get("name"):
+                sample["answers"].add(event["name"])
+            if event.get("timings"):
+                sample["recorded_timings"].append(event["timings"])
+        elif event["type"] == "correction":
+            sample["corrected"] = True
+            if event.get("previous_name"):
+                sample["known_wrong"].add(event["previous_name"])
+            if event.get("name"):
+                sample["label"] = event["name"]
+
+    for sample in samples.values():
+        if sample["label"] is None and not sample["corrected"]:
+            if len(sample["answers"]) > 1:
+                sample["ambiguous"] = True
+            else:
+                sample["label"] = sample["initial_name"]
+        if sample["label"] in sample["known_wrong"]:
+            sample["label"] = None
+    return [sample for sample in samples.values() if sample["label"] or sample["known_wrong"] or sample["ambiguous"]]
+
+
+def load_image(image_hash):
+    with open(f"{CAPTURE_IMAGE_DIR}/{image_hash}.bin", 'rb') as f:
+        return f.read()
+
+
+async def preprocess_none(image_bytes):
+    image_bytes.seek(0)
+    return image_bytes
+
+
+async def identify_recorded(image_bytes, sample, args):
+    return sample["initial_name"]
+
+
+async def identify_gemini(image_bytes, sample, args):
+    if not hasattr(args, "gemini_model"):
+        args.gemini_model = genai.GenerativeModel(args.model)
+    return await asyncio.wait_for(identify_pokemon(image_bytes, model=args.gemini_model), timeout=15)
+
+
+PREPROCESSORS = {
+    "rembg": remove_background,
+    "none": preprocess_none,
+}
+
+BACKENDS = {
+    "recorded": identify_recorded,
+    "gemini": identify_gemini,
+}
+
+
+async def evaluate_sample(sample, args):
+    preprocess = PREPROCESSORS[args.preprocess]
+    backend = BACKENDS[args.backend]
+    timings = {}
+
+    image_bytes = BytesIO(load_image(sample["image"]))
+
+    stage_start = time.perf_counter()
+    try:
+        processed_image = await asyncio.wait_for(preprocess(image_bytes), timeout=15)
+    except asyncio.TimeoutError:
+        image_bytes.seek(0)
+        processed_image = image_bytes
+    timings["background"] = time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
+    try:
+        name = await backend(processed_image, sample, args)
+    except Exception as err:
+        print(f"Identification error for {sample['image']}: {err}")
+        name = None
+    timings["identify"] = time.perf_counter() - stage_start
+
+    return {
+        "image": sample["image"],
+        "label": sample["label"],
+        "corrected": sample["corrected"],
+        "name": name,
+        "agrees": sample["label"] is not None and name == sample["label"],
+        "known_wrong": name in sample["known_wrong"],
+        "timings": timings,
+        "recorded_timings": sample["recorded_timings"]
+    }
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def print_agreement(title, results):
+    agrees = sum(result["agrees"] for result in results)
+    print(f"{title}: {agrees / len(results):.1%} ({agrees}/{len(results)})")
+
+
+def summarize(results):
+    total = len(results)
+    uncorrected = [result for result in results if not result["corrected"]]
+    corrected = [result for result in results if result["corrected"]]
+    relabelled = [result for result in corrected if result["label"] is not None]
+
+    print(f"Samples: {total} ({len(uncorrected)} uncorrected, {len(corrected)} corrected)")
+    if not total:
+        return
+
+    failed = sum(result["name"] is None for result in results)
+    print(f"Failed identifications: {failed}")
+    print("Labels are the production model's own answers, not verified species; agreement is not accuracy.")
+
+    if uncorrected:
+        print_agreement("Agreement with production answer (uncorrected)", uncorrected)
+
+    if corrected:
+        known_wrong = sum(result["known_wrong"] for result in corrected)
+        print(f"Repeated known-wrong answers (corrected): {known_wrong / len(corrected):.1%} ({known_wrong}/{len(corrected)})")
+    if relabelled:
+        print_agreement("Agreement with correction answer (corrected)", relabelled)
+
+    for stage in TIMED_STAGES:
+        replayed = [result["timings"][stage] for result in results]
+        recorded = [
+            timings[stage]
+            for result in results
+            for timings in result["recorded_timings"]
+            if stage in timings
+        ]
+        print(
+            f"{stage}: replay p50 {percentile(replayed, 0.5) * 1000:.0f}ms, p95 {percentile(replayed, 0.95) * 1000:.0f}ms"
+            f" | recorded p50 {percentile(recorded, 0.5) * 1000:.0f}ms, p95 {percentile(recorded, 0.95) * 1000:.0f}ms"
+            f" ({len(recorded)} runs)"
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Replay captured spawns against an identifier backend")
+    parser.add_argument("--events", default=CAPTURE_EVENTS_FILE, help="capture events file")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="gemini")
+    parser.add_argument("--model", default="gemini-2.5-flash-preview-04-17", help="Gemini model name")
+    parser.add_argument("--preprocess", choices=sorted(PREPROCESSORS), default="rembg")
+    parser.add_argument("--corrected-only", action="store_true", help="only replay images that received a correction")
+    parser.add_argument("--limit", type=int, default=0, help="maximum number of images to replay")
+    parser.add_argument("--output", help="write per-image results as JSONL")
+    args = parser.parse_args()
+
+    logger.removeHandler(file_handler)
+
+    if not os.path.exists(args.events):
+        print(f"No capture found at {args.events}. Set CAPTURE_DATASET=true in .env and let the bot record some spawns first.")
+        return
+
+    samples = load_dataset(args.events)
+    ambiguous = [sample for sample in samples if sample["ambiguous"]]
+    if ambiguous:
+        print(f"Skipping {len(ambiguous)} images with conflicting uncorrected answers")
+    samples = [sample for sample in samples if not sample["ambiguous"]]
+    if args.corrected_only:
+        samples = [sample for sample in samples if sample["corrected"]]
+    if args.limit:
+        samples = samples[:args.limit]
+
+    results = []
+    for sample in samples:
+        try:
+            results.append(await evaluate_sample(sample, args))
+        except FileNotFoundError:
+            print(f"Missing image blob for {sample['image']}, skipping")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+    summarize(results)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -18,6 +18,9 @@ from PIL import Image
 import cv2
 import numpy as np
 import random
+import hashlib
+import heapq
+from collections import deque
 
 load_dotenv()
 
@@ -49,6 +52,18 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 POKETWO_ID = 716390085896962058
 SUBSCRIPTION_FILE = 'data/subscriptions.json'
 SAVE_INTERVAL = 300
+SPAWN_WINDOW = 600
+PIPELINE_WORKERS = 3
+SPAWN_QUEUE_LIMIT = 20
+SPAWN_MAX_AGE = 60
+GUILD_SPAWN_BUDGET = 20
+CAPTURE_ENABLED = os.getenv("CAPTURE_DATASET", "false").lower() == "true"
+CAPTURE_DIR = 'data/capture'
+CAPTURE_IMAGE_DIR = f'{CAPTURE_DIR}/images'
+CAPTURE_EVENTS_FILE = f'{CAPTURE_DIR}/events.jsonl'
+CAPTURE_MAX_BYTES = 30 * 1024 * 1024
+CAPTURE_BACKUP_COUNT = 5
+CAPTURE_IMAGE_GRACE = 3600
 
 intents = discord.Intents.default()
 intents.message_content = True
@@ -62,6 +77,15 @@ pending_corrections = {}
 POKEMON_COLOR_CACHE = {}
 last_save_time = 0
 
+guild_spawn_times = {}
+guild_processed_times = {}
+guild_stats = {}
+spawn_queue = []
+spawn_queue_ready = None
+spawn_sequence = 0
+active_workers = 0
+pipeline_workers = []
+
 
 def load_subscriptions():
     global subscribed_users
@@ -151,6 +175,207 @@ async def rotating_status():
             await asyncio.sleep(60)
 
 
+def get_guild_stats(guild_id):
+    if guild_id not in guild_stats:
+        guild_stats[guild_id] = {
+            "spawns": 0,
+            "processed": 0,
+            "skipped": 0,
+            "throttled": 0,
+            "gemini_calls": 0,
+            "processing_time": 0.0
+        }
+    return guild_stats[guild_id]
+
+
+def prune_window(timestamps, current_time):
+    while timestamps and current_time - timestamps[0] > SPAWN_WINDOW:
+        timestamps.popleft()
+    return len(timestamps)
+
+
+def count_guild_subscribers(guild_id):
+    return sum(1 for guilds in subscribed_users.values() if guild_id in guilds)
+
+
+def count_gemini_call(guild_id):
+    if guild_id is not None:
+        get_guild_stats(guild_id)["gemini_calls"] += 1
+
+
+def guild_spawn_rate(guild_id):
+    timestamps = guild_spawn_times.get(guild_id)
+    if not timestamps:
+        return 0.0
+    return prune_window(timestamps, time.time()) * 60 / SPAWN_WINDOW
+
+
+def spawn_priority(subscriber_count, spawns_per_minute):
+    return subscriber_count / (1 + spawns_per_minute)
+
+
+def schedule_spawn(image_url, guild_id, guild_name, message_link):
+    global spawn_sequence
+    current_time = time.time()
+    stats = get_guild_stats(guild_id)
+    stats["spawns"] += 1
+
+    guild_spawn_times.setdefault(guild_id, deque()).append(current_time)
+    spawns_per_minute = guild_spawn_rate(guild_id)
+
+    subscriber_count = count_guild_subscribers(guild_id)
+    if subscriber_count == 0:
+        stats["skipped"] += 1
+        return
+
+    if spawn_queue_ready is None:
+        logger.warning("Spawn queue not ready, dropping spawn")
+        stats["throttled"] += 1
+        return
+
+    processed_count = prune_window(guild_processed_times.setdefault(guild_id, deque()), current_time)
+    free_workers = PIPELINE_WORKERS - active_workers
+    saturated = free_workers <= 0 or len(spawn_queue) > free_workers
+    if saturated and processed_count >= GUILD_SPAWN_BUDGET:
+        logger.info(f"Pipeline saturated, {guild_name} is over its spawn budget")
+        stats["throttled"] += 1
+        return
+
+    spawn_sequence += 1
+    entry = (-spawn_priority(subscriber_count, spawns_per_minute), spawn_sequence, {
+        "image_url": image_url,
+        "guild_id": guild_id,
+        "guild_name": guild_name,
+        "message_link": message_link,
+        "queued_at": current_time
+    })
+
+    if len(spawn_queue) >= SPAWN_QUEUE_LIMIT:
+        lowest = max(spawn_queue)
+        if lowest[0] <= entry[0]:
+            logger.warning(f"Spawn queue full, dropping spawn from {guild_name}")
+            stats["throttled"] += 1
+            return
+        spawn_queue.remove(lowest)
+        heapq.heapify(spawn_queue)
+        logger.warning(f"Spawn queue full, evicting spawn from {lowest[2]['guild_name']}")
+        get_guild_stats(lowest[2]["guild_id"])["throttled"] += 1
+
+    heapq.heappush(spawn_queue, entry)
+    spawn_queue_ready.set()
+
+
+async def pipeline_worker():
+    global active_workers
+    while True:
+        while not spawn_queue:
+            spawn_queue_ready.clear()
+            await spawn_queue_ready.wait()
+        _, _, job = heapq.heappop(spawn_queue)
+        stats = get_guild_stats(job["guild_id"])
+        try:
+            if time.time() - job["queued_at"] > SPAWN_MAX_AGE:
+                logger.info(f"Dropping stale spawn from {job['guild_name']}")
+                stats["throttled"] += 1
+                continue
+
+            active_workers += 1
+            processed_times = guild_processed_times.setdefault(job["guild_id"], deque())
+            current_time = time.time()
+            processed_times.append(current_time)
+            prune_window(processed_times, current_time)
+            start_time = time.perf_counter()
+            try:
+                await process_pokemon_image(job["image_url"], job["guild_id"], job["guild_name"], job["message_link"])
+            finally:
+                active_workers -= 1
+                stats["processed"] += 1
+                stats["processing_time"] += time.perf_counter() - start_time
+        except Exception as err:
+            logger.error(f"Pipeline worker error: {err}")
+
+
+def start_pipeline_workers():
+    global spawn_queue_ready
+    if pipeline_workers:
+        return
+    spawn_queue_ready = asyncio.Event()
+    for _ in range(PIPELINE_WORKERS):
+        pipeline_workers.append(bot.loop.create_task(pipeline_worker()))
+    logger.info(f"Started {PIPELINE_WORKERS} pipeline workers")
+
+
+def capture_image(image_data):
+    image_hash = hashlib.sha256(image_data).hexdigest()
+    if not CAPTURE_ENABLED:
+        return image_hash
+    try:
+        os.makedirs(CAPTURE_IMAGE_DIR, exist_ok=True)
+        image_path = f"{CAPTURE_IMAGE_DIR}/{image_hash}.bin"
+        if os.path.exists(image_path):
+            os.utime(image_path)
+        else:
+            temp_file = f"{image_path}.tmp"
+            with open(temp_file, 'wb') as f:
+                f.write(image_data)
+            os.replace(temp_file, image_path)
+    except Exception as err:
+        logger.error(f"Error capturing image: {err}")
+    return image_hash
+
+
+def rotate_capture_events():
+    for index in range(CAPTURE_BACKUP_COUNT - 1, 0, -1):
+        source = f"{CAPTURE_EVENTS_FILE}.{index}"
+        if os.path.exists(source):
+            os.replace(source, f"{CAPTURE_EVENTS_FILE}.{index + 1}")
+    os.replace(CAPTURE_EVENTS_FILE, f"{CAPTURE_EVENTS_FILE}.1")
+    asyncio.get_event_loop().run_in_executor(None, prune_capture_images)
+
+
+def prune_capture_images():
+    try:
+        referenced = set()
+        events_files = [CAPTURE_EVENTS_FILE] + [f"{CAPTURE_EVENTS_FILE}.{index}" for index in range(1, CAPTURE_BACKUP_COUNT + 1)]
+        for events_file in events_files:
+            if not os.path.exists(events_file):
+                continue
+            with open(events_file, 'r') as f:
+                for line in f:
+                    try:
+                        referenced.add(json.loads(line)["image"])
+                    except (json.JSONDecodeError, KeyError):
+                        continue
+
+        current_time = time.time()
+        removed = 0
+        for entry in os.scandir(CAPTURE_IMAGE_DIR):
+            image_hash = entry.name.split(".")[0]
+            if image_hash in referenced or current_time - entry.stat().st_mtime < CAPTURE_IMAGE_GRACE:
+                continue
+            os.remove(entry.path)
+            removed += 1
+
+        if removed:
+            logger.info(f"Removed {removed} unreferenced capture images")
+    except Exception as err:
+        logger.error(f"Error pruning capture images: {err}")
+
+
+def record_capture_event(event_type, **fields):
+    if not CAPTURE_ENABLED:
+        return
+    try:
+        os.makedirs(CAPTURE_DIR, exist_ok=True)
+        if os.path.exists(CAPTURE_EVENTS_FILE) and os.path.getsize(CAPTURE_EVENTS_FILE) >= CAPTURE_MAX_BYTES:
+            rotate_capture_events()
+        event = {"type": event_type, "timestamp": time.time(), **fields}
+        with open(CAPTURE_EVENTS_FILE, 'a') as f:
+            f.write(json.dumps(event, separators=(',', ':')) + "\n")
+    except Exception as err:
+        logger.error(f"Error recording capture event: {err}")
+
+
 async def fetch_image(session, url):
     async with session.get(url) as response:
         return await response.read()
@@ -263,13 +488,18 @@ async def on_interaction(interaction: discord.Interaction):
 
                 try:
                     async with aiohttp.ClientSession() as session:
+                        timings = {}
+                        stage_start = time.perf_counter()
                         image_data = await fetch_image(session, data["image_url"])
+                        timings["fetch"] = time.perf_counter() - stage_start
                         if not image_data:
                             await interaction.followup.send("Failed to fetch the image. Please try again.")
                             return
 
+                        image_hash = data.get("image_hash") or capture_image(image_data)
                         image_bytes = BytesIO(image_data)
 
+                        stage_start = time.perf_counter()
                         try:
                             processed_image = await asyncio.wait_for(
                                 remove_background(image_bytes),
@@ -279,18 +509,36 @@ async def on_interaction(interaction: discord.Interaction):
                             logger.warning("Background removal timed out during correction")
                             image_bytes.seek(0)
                             processed_image = image_bytes
+                        timings["background"] = time.perf_counter() - stage_start
 
                         original_embed = interaction.message.embeds[0]
                         previous_name = None
                         if original_embed.description and "I spotted a **" in original_embed.description:
                             previous_name = original_embed.description.split("I spotted a **")[1].split("**")[0].lower()
 
+                        stage_start = time.perf_counter()
+                        timed_out = False
                         try:
                             new_name = await asyncio.wait_for(
-                                identify_pokemon(processed_image, previous_name),
+                                identify_pokemon(processed_image, previous_name, guild_id=data.get("guild_id")),
                                 timeout=15
                             )
                         except asyncio.TimeoutError:
+                            new_name = None
+                            timed_out = True
+                        timings["identify"] = time.perf_counter() - stage_start
+
+                        record_capture_event(
+                            "correction",
+                            image=image_hash,
+                            guild_id=data.get("guild_id"),
+                            correction_id=correction_id,
+                            previous_name=previous_name,
+                            name=new_name if new_name != previous_name else None,
+                            timings=timings
+                        )
+
+                        if timed_out:
                             await interaction.followup.send("Identification timed out. Please try again later.")
                             return
 
@@ -344,6 +592,7 @@ async def on_interaction(interaction: discord.Interaction):
 async def on_ready():
     logger.info(f"{bot.user} is online and ready!")
     load_subscriptions()
+    start_pipeline_workers()
 
     await bot.change_presence(
         activity=discord.Activity(
@@ -401,7 +650,7 @@ async def on_message(message):
                     break
 
         if image_url:
-            await process_pokemon_image(image_url, guild_id, guild_name, message_link)
+            schedule_spawn(image_url, guild_id, guild_name, message_link)
 
     await bot.process_commands(message)
 
@@ -410,13 +659,18 @@ async def process_pokemon_image(image_url, guild_id, guild_name, message_link):
     try:
         async with aiohttp.ClientSession() as session:
             try:
+                timings = {}
+                stage_start = time.perf_counter()
                 image_data = await fetch_image(session, image_url)
+                timings["fetch"] = time.perf_counter() - stage_start
                 if not image_data:
                     logger.error("Failed to fetch image data")
                     return
 
+                image_hash = capture_image(image_data)
                 image_bytes = BytesIO(image_data)
 
+                stage_start = time.perf_counter()
                 try:
                     processed_image = await asyncio.wait_for(
                         remove_background(image_bytes),
@@ -426,73 +680,50 @@ async def process_pokemon_image(image_url, guild_id, guild_name, message_link):
                     logger.warning("Background removal timed out, using original image")
                     image_bytes.seek(0)
                     processed_image = image_bytes
+                timings["background"] = time.perf_counter() - stage_start
 
+                stage_start = time.perf_counter()
                 try:
                     pokemon_name = await asyncio.wait_for(
-                        identify_pokemon(processed_image),
+                        identify_pokemon(processed_image, guild_id=guild_id),
                         timeout=15
                     )
                 except asyncio.TimeoutError:
                     logger.warning("Pokemon identification timed out")
-                    return
+                    pokemon_name = None
+                timings["identify"] = time.perf_counter() - stage_start
 
                 if not pokemon_name:
                     logger.warning("Failed to identify pokemon")
+                    record_capture_event("identification", image=image_hash, guild_id=guild_id, name=None, timings=timings)
                     return
 
+                stage_start = time.perf_counter()
                 pokemon_color = await get_pokemon_color(pokemon_name)
+                timings["color"] = time.perf_counter() - stage_start
                 correction_id = str(uuid.uuid4())
 
+                record_capture_event(
+                    "identification",
+                    image=image_hash,
+                    guild_id=guild_id,
+                    correction_id=correction_id,
+                    name=pokemon_name,
+                    timings=timings
+                )
+
                 pending_corrections[correction_id] = {
                     "image_url": image_url,
+                    "image_hash": image_hash,
+                    "guild_id": guild_id,
                     "guild_name": guild_name,
                     "message_link": message_link,
                     "timestamp": time.time()
                 }
 
-                user_count = 0
-                for user_id, guilds in subscribed_users.items():
-                    if guild_id in guilds:
-                        try:
-                            if user_count > 0 and user_count % 5 == 0:
-                                await asyncio.sleep(1)
-
-                            user = await bot.fetch_user(user_id)
-                            embed = discord.Embed(
-                                title="Wild Pokémon Appeared! ✨",
-                                description=f"I spotted a **{pokemon_name.capitalize()}** in **{guild_name}**!",
-                                color=pokemon_color
-                            )
-                            embed.add_field(
-                                name="Catch Command",
-                                value=f"```<@716390085896962058> catch {pokemon_name}```",
-                                inline=False
-                            )
-                            embed.add_field(
-                                name="Server Location",
-                                value=f"[Click here to go to the message]({message_link})",
-                                inline=False
-                            )
-                            embed.set_thumbnail(url=image_url)
-                            embed.set_footer(text=f"PokéDetector | Guild: {guild_name}")
-
-                            view = discord.ui.View()
-                            view.add_item(discord.ui.Button(
-                                label="Wrong Pokemon",
-                                style=discord.ButtonStyle.danger,
-                                custom_id=f"wrong_pokemon:{correction_id}"
-                            ))
-
-                            await user.send(content=f"<@716390085896962058> catch {pokemon_name}", embed=embed, view=view)
-                            user_count += 1
-                        except discord.errors.HTTPException as http_err:
-                            if http_err.status == 429:
-                                logger.warning(f"Rate limited when DMing users. Sleeping for 5 seconds.")
-                                await asyncio.sleep(5)
-                            else:
-                                logger.error(f"HTTP error when DMing user {user_id}: {http_err}")
-                        except Exception as err:
-                            logger.error(f"Failed to DM user {user_id}: {err}")
+                bot.loop.create_task(notify_subscribers(
+                    pokemon_name, pokemon_color, correction_id, image_url, guild_id, guild_name, message_link
+                ))
 
             except aiohttp.ClientError as ce:
                 logger.error(f"Connection error: {ce}")
@@ -502,6 +733,52 @@ async def process_pokemon_image(image_url, guild_id, guild_name, message_link):
         logger.error(f"Fatal error processing Pokémon image: {err}")
 
 
+async def notify_subscribers(pokemon_name, pokemon_color, correction_id, image_url, guild_id, guild_name, message_link):
+    user_count = 0
+    for user_id, guilds in list(subscribed_users.items()):
+        if guild_id in guilds:
+            try:
+                if user_count > 0 and user_count % 5 == 0:
+                    await asyncio.sleep(1)
+
+                user = await bot.fetch_user(user_id)
+                embed = discord.Embed(
+                    title="Wild Pokémon Appeared! ✨",
+                    description=f"I spotted a **{pokemon_name.capitalize()}** in **{guild_name}**!",
+                    color=pokemon_color
+                )
+                embed.add_field(
+                    name="Catch Command",
+                    value=f"```<@716390085896962058> catch {pokemon_name}```",
+                    inline=False
+                )
+                embed.add_field(
+                    name="Server Location",
+                    value=f"[Click here to go to the message]({message_link})",
+                    inline=False
+                )
+                embed.set_thumbnail(url=image_url)
+                embed.set_footer(text=f"PokéDetector | Guild: {guild_name}")
+
+                view = discord.ui.View()
+                view.add_item(discord.ui.Button(
+                    label="Wrong Pokemon",
+                    style=discord.ButtonStyle.danger,
+                    custom_id=f"wrong_pokemon:{correction_id}"
+                ))
+
+                await user.send(content=f"<@716390085896962058> catch {pokemon_name}", embed=embed, view=view)
+                user_count += 1
+            except discord.errors.HTTPException as http_err:
+                if http_err.status == 429:
+                    logger.warning(f"Rate limited when DMing users. Sleeping for 5 seconds.")
+                    await asyncio.sleep(5)
+                else:
+                    logger.error(f"HTTP error when DMing user {user_id}: {http_err}")
+            except Exception as err:
+                logger.error(f"Failed to DM user {user_id}: {err}")
+
+
 async def get_pokemon_color(pokemon_name):
     if pokemon_name in POKEMON_COLOR_CACHE:
         return POKEMON_COLOR_CACHE[pokemon_name]
@@ -529,7 +806,8 @@ async def get_pokemon_color(pokemon_name):
         return 0xFF5252
 
 
-async def identify_pokemon(image_bytes, previous_name=None):
+async def identify_pokemon(image_bytes, previous_name=None, model=None, guild_id=None):
+    model = model or gemini_model
     try:
         image_bytes.seek(0)
 
@@ -538,9 +816,10 @@ async def identify_pokemon(image_bytes, previous_name=None):
         else:
             prompt = "What Pokémon is this? Reply ONLY with the lowercase English name, nothing else."
 
+        count_gemini_call(guild_id)
         try:
             response = await asyncio.wait_for(
-                gemini_model.generate_content_async([
+                model.generate_content_async([
                     prompt,
                     {"mime_type": "image/png", "data": image_bytes.read()}
                 ]),
@@ -557,9 +836,10 @@ async def identify_pokemon(image_bytes, previous_name=None):
             image_bytes.seek(0)
             retry_prompt = f"This is definitely NOT {previous_name}. Look more carefully at the distinctive features. What other Pokémon species could this be? Reply ONLY with the lowercase English name, nothing else."
 
+            count_gemini_call(guild_id)
             try:
                 retry_response = await asyncio.wait_for(
-                    gemini_model.generate_content_async([
+                    model.generate_content_async([
                         retry_prompt,
                         {"mime_type": "image/png", "data": image_bytes.read()}
                     ]),
@@ -679,6 +959,28 @@ async def stats(interaction: discord.Interaction):
     embed.add_field(name="Subscribed Users", value=f"`{user_count}` users", inline=True)
     embed.add_field(name="Total Subscriptions", value=f"`{total_subscriptions}` subscriptions", inline=True)
 
+    embed.add_field(name="Pipeline", value=f"`{active_workers}/{PIPELINE_WORKERS}` workers busy, `{len(spawn_queue)}` queued", inline=False)
+
+    if await bot.is_owner(interaction.user):
+        top_guilds = sorted(guild_stats.items(), key=lambda item: item[1]["gemini_calls"], reverse=True)[:5]
+    elif interaction.guild_id in guild_stats:
+        top_guilds = [(interaction.guild_id, guild_stats[interaction.guild_id])]
+    else:
+        top_guilds = []
+
+    if top_guilds:
+        guild_lines = []
+        for guild_id, guild_data in top_guilds:
+            guild = bot.get_guild(guild_id)
+            server_name = guild.name if guild else f"Unknown Server ({guild_id})"
+            guild_lines.append(
+                f"• **{server_name}**: `{guild_spawn_rate(guild_id):.1f}`/min, `{count_guild_subscribers(guild_id)}` subs, "
+                f"`{guild_data['processed']}`/`{guild_data['spawns']}` processed, "
+                f"`{guild_data['skipped'] + guild_data['throttled']}` skipped, "
+                f"`{guild_data['gemini_calls']}` Gemini calls, `{guild_data['processing_time']:.1f}`s"
+            )
+        embed.add_field(name="Per-Server Cost", value="\n".join(guild_lines)[:1024], inline=False)
+
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 